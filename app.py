@@ -1,15 +1,28 @@
 import os
 import re
-import json
+import hmac
 import time
+import hashlib
+import functools
+import contextlib
+import shutil
 import tempfile
 import logging
+import threading
 import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Tuple
+from urllib.parse import quote
 
+import orjson
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError, BotoCoreError
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -22,13 +35,34 @@ AWS_REGION          = os.getenv("AWS_REGION", "us-east-2")
 S3_BUCKET           = os.getenv("S3_BUCKET", "")
 OUTPUT_PREFIX       = os.getenv("OUTPUT_PREFIX", "renders/")
 OVERLAY_S3_KEY      = os.getenv("OVERLAY_S3_KEY", "").strip()
+OVERLAY_REFRESH_SEC = int(os.getenv("OVERLAY_REFRESH_SEC", "300"))  # ETag re-check interval for the cached overlay
 MAKE_PUBLIC         = os.getenv("MAKE_PUBLIC", "false").lower() == "true"
+PUBLIC_BASE_URL     = os.getenv("PUBLIC_BASE_URL", "").strip().rstrip("/")  # e.g. a CDN in front of S3_BUCKET
 PRESIGN_TTL         = int(os.getenv("PRESIGN_TTL", "43200"))  # 0 disables presign
+S3_MAX_CONCURRENCY  = int(os.getenv("S3_MAX_CONCURRENCY", "16"))  # parallel multipart parts per upload
+S3_MAX_PART_MB      = int(os.getenv("S3_MAX_PART_MB", "64"))
+OUTPUT_CACHE_CONTROL = os.getenv("OUTPUT_CACHE_CONTROL", "public, max-age=3600").strip()  # "" to omit
+# Pipe ffmpeg straight into a multipart upload (no output file). Output is then
+# fragmented MP4 instead of +faststart, hence opt-in.
+STREAM_UPLOAD       = os.getenv("STREAM_UPLOAD", "false").lower() == "true"
+# edge-accelerated endpoint; the bucket must have Transfer Acceleration enabled
+S3_ACCELERATE       = os.getenv("S3_ACCELERATE", "false").lower() in ("1", "true")
 
 # Render settings
 TARGET_FPS          = int(os.getenv("TARGET_FPS", "20"))
 FFMPEG_BIN          = os.getenv("FFMPEG_BIN", "ffmpeg")
 FFPROBE_BIN         = os.getenv("FFPROBE_BIN", "ffprobe")
+H264_ENCODER        = os.getenv("H264_ENCODER", "auto").strip()  # auto | libx264 | h264_nvenc | h264_qsv | h264_vaapi | h264_videotoolbox
+VAAPI_DEVICE        = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128").strip()
+X264_PRESET         = os.getenv("X264_PRESET", "veryfast").strip()
+X264_CRF            = os.getenv("X264_CRF", "23").strip()
+X264_QP             = os.getenv("X264_QP", "").strip()  # fixed QP instead of CRF (skips rate control; bigger files)
+X264_THREADS        = os.getenv("X264_THREADS", "0").strip()  # 0 = cores split across workers and in-flight renders
+WEB_CONCURRENCY     = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))  # gunicorn workers sharing the cores (set by gunicorn.conf.py)
+# "zerolatency" switches x264 to sliced threads (lower wall time on short clips)
+# but drops B-frames/lookahead, so files get bigger; empty keeps frame threading
+X264_TUNE           = os.getenv("X264_TUNE", "").strip()
+X264_PARAMS         = os.getenv("X264_PARAMS", "").strip()  # raw -x264-params, e.g. "sliced-threads=1:rc-lookahead=0"
 
 # HTTP
 HEADERS             = {"User-Agent": "cloud-renderer/1.0 (+https://render.com)"}
@@ -47,9 +81,26 @@ BREEZE_ASSETS_URL_TEMPLATE = os.getenv("BREEZE_ASSETS_URL_TEMPLATE", "").strip()
 BREEZE_API_AUTH_HEADER     = os.getenv("BREEZE_API_AUTH_HEADER", "Authorization").strip()  # usually "Authorization"
 BREEZE_API_AUTH_PREFIX     = os.getenv("BREEZE_API_AUTH_PREFIX", "Bearer ").strip()        # usually "Bearer "
 
+# Scratch space: RAM-backed tmpfs for intermediates when it has room
+USE_SHM_TMP         = os.getenv("USE_SHM_TMP", "true").lower() == "true"
+SHM_DIR             = os.getenv("SHM_DIR", "/dev/shm")
+SHM_MIN_FREE_MB     = int(os.getenv("SHM_MIN_FREE_MB", "512"))
+MAX_TMP_MB          = int(os.getenv("MAX_TMP_MB", "-1"))  # per-render scratch budget; 503 when < 2x is free (0 = off, unset = auto)
+
+# Background rendering: ack the webhook with 202 and render on a worker pool
+ASYNC_RENDER        = os.getenv("ASYNC_RENDER", "false").lower() == "true"
+RENDER_WORKERS      = int(os.getenv("RENDER_WORKERS", "4"))
+RENDER_QUEUE_MAX    = int(os.getenv("RENDER_QUEUE_MAX", "32"))  # queued + running; 503 beyond this
+RENDER_CACHE_SIZE   = int(os.getenv("RENDER_CACHE_SIZE", "1024"))  # finished renders remembered for webhook retries
+
+# Source download: parallel HTTP Range parts when the origin supports them
+DOWNLOAD_PART_MB     = int(os.getenv("DOWNLOAD_PART_MB", "8"))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+DOWNLOAD_PART_TRIES  = int(os.getenv("DOWNLOAD_PART_TRIES", "5"))
+
 # Resolver retries
 RESOLVE_TRIES        = int(os.getenv("RESOLVE_TRIES", "6"))
-RESOLVE_SLEEP_SEC    = float(os.getenv("RESOLVE_SLEEP_SEC", "2.0"))
+RESOLVE_SLEEP_SEC    = float(os.getenv("RESOLVE_SLEEP_SEC", "0.25"))  # first backoff; grows 1.5x per try
 
 # ──────────────────────────────────────────────────────────────────────────────
 # App + AWS
@@ -58,75 +109,361 @@ app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
 logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
+if USE_SHM_TMP and os.path.isdir(SHM_DIR) and shutil.disk_usage(SHM_DIR).free > SHM_MIN_FREE_MB * 1024 * 1024:
+    # TemporaryDirectory() now allocates on tmpfs instead of the container's overlayfs;
+    # own subdir so our scratch is easy to find (and clean) next to other tenants
+    _shm_root = os.path.join(SHM_DIR, "cloud-renderer")
+    os.makedirs(_shm_root, exist_ok=True)
+    tempfile.tempdir = _shm_root
+if MAX_TMP_MB < 0:
+    # tmpfs is container RAM: keep refusing webhooks once free space drops
+    # below the same floor checked above, instead of letting a burst OOM us
+    MAX_TMP_MB = SHM_MIN_FREE_MB // 2 if tempfile.tempdir == os.path.join(SHM_DIR, "cloud-renderer") else 0
+app.logger.info("Scratch dir: %s (per-render budget %d MB)", tempfile.gettempdir(), MAX_TMP_MB)
+
 session = boto3.session.Session(region_name=AWS_REGION)
-s3 = session.client("s3")
+# One long-lived client: pooled keep-alive connections shared by uploads,
+# overlay downloads and presigning across requests.
+s3 = session.client("s3", config=BotoConfig(
+    signature_version="s3v4",
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={"max_attempts": 10, "mode": "adaptive"},  # client-side rate limiting on throttles
+    # acceleration endpoints don't exist for dotted bucket names
+    s3={"use_accelerate_endpoint": S3_ACCELERATE and "." not in S3_BUCKET},
+))
+# Multipart + parallel parts for rendered outputs (tens of MB)
+MB = 1024 * 1024
+S3_TRANSFER = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=8 * MB,
+    max_concurrency=S3_MAX_CONCURRENCY,
+    use_threads=True,
+    max_io_queue=100,
+    io_chunksize=1 * MB,  # per read/write syscall; the 256 KiB default costs 4x the calls
+)
+
+def _upload_transfer_config(size: int) -> TransferConfig:
+    """Parts sized so every worker gets one: 8 MiB floor, S3_MAX_PART_MB cap.
+    Big outputs get big parts (fewer requests); small ones still fan out."""
+    part = min(max(8 * MB, -(-size // S3_MAX_CONCURRENCY)), S3_MAX_PART_MB * MB)
+    return TransferConfig(
+        multipart_threshold=8 * MB,
+        multipart_chunksize=part,
+        max_concurrency=S3_MAX_CONCURRENCY,
+        use_threads=True,
+        io_chunksize=1 * MB,
+    )
+
+RETRY_AFTER_MAX_SEC = 5
+
+class _CappedRetry(Retry):
+    """Honour Retry-After, but never sleep longer than RETRY_AFTER_MAX_SEC."""
+    def get_retry_after(self, response):
+        after = super().get_retry_after(response)
+        return None if after is None else min(after, RETRY_AFTER_MAX_SEC)
+
+def _make_session(retry: Retry) -> requests.Session:
+    s = requests.Session()
+    s.headers.update(HEADERS)  # UA on every call, merged by requests
+    s.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=50, max_retries=retry))
+    s.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=50, max_retries=retry))
+    return s
+
+# One pooled HTTP session: keep-alive lets downloads (and Breeze API calls)
+# reuse TCP/TLS connections instead of handshaking per request.
+# Transport retries (connect resets, 408/429/5xx) happen on the warm pool;
+# POSTs are only retried if the connection never opened. 429/503 wait out
+# Retry-After (capped).
+http_session = _make_session(_CappedRetry(
+    total=5, backoff_factor=0.5, status_forcelist=(408, 429, 500, 502, 503, 504),
+    allowed_methods=frozenset(("GET", "HEAD")), respect_retry_after_header=True,
+    raise_on_status=False))
+# Callers with their own retry loop (resolver, Range parts): connection
+# retries only, so attempts don't multiply and a 503ing origin fails fast.
+loop_session = _make_session(Retry(total=2, read=0, status=0, backoff_factor=0.5,
+                                    respect_retry_after_header=False))
+
+# Render workers for ASYNC_RENDER (ffmpeg itself runs out of process)
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+# Shared pool for independent per-request network I/O (source + overlay fetch)
+io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="io")
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────────────────────
 def _run(cmd: list[str]) -> Tuple[int, str]:
-    app.logger.info("FFmpeg cmd: %s", " ".join(cmd))
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    out = []
-    for line in p.stdout:
-        out.append(line)
-    code = p.wait()
-    return code, "".join(out)
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("FFmpeg cmd: %s", " ".join(cmd))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = p.communicate()
+    return p.returncode, out.decode("utf-8", "ignore")
+
+def _fetch(url: str, timeout: int = REQUEST_TIMEOUT, stream: bool = False) -> requests.Response:
+    return loop_session.get(url, timeout=timeout, allow_redirects=True, stream=stream)
+
+def _pwrite_stream(raw, fd: int, off: int) -> int:
+    """Copy an undecoded response body into fd from offset off; returns the end offset."""
+    while True:
+        buf = raw.read(4 * MB, decode_content=False)
+        if not buf:
+            return off
+        os.pwrite(fd, buf, off)
+        off += len(buf)
+
+class _RangeUnsupported(Exception):
+    """A Range part came back as something other than 206."""
 
-def _fetch(url: str, timeout: int = REQUEST_TIMEOUT) -> requests.Response:
-    return requests.get(url, headers=HEADERS, timeout=timeout, allow_redirects=True)
+def _download_range(url: str, fd: int, lo: int, hi: int, etag: Optional[str]):
+    """GET bytes lo..hi (inclusive) into fd at offset lo, retrying with backoff."""
+    hdrs = {"Accept-Encoding": "identity", "Range": f"bytes={lo}-{hi}"}
+    if etag:
+        hdrs["If-Range"] = etag  # a changed object answers 200, not a mixed file
+    for attempt in range(DOWNLOAD_PART_TRIES):
+        try:
+            with loop_session.get(url, stream=True, timeout=REQUEST_TIMEOUT, headers=hdrs) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise _RangeUnsupported(f"range {lo}-{hi} answered {r.status_code}")
+                off = _pwrite_stream(r.raw, fd, lo)
+            if off == hi + 1:
+                return
+            raise requests.ConnectionError(f"short range read {lo}-{hi}: got {off - lo} bytes")
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_PART_TRIES - 1:
+                raise
+            app.logger.warning("Range %d-%d failed (%s); retrying", lo, hi, e)
+            time.sleep(min(0.5 * 2 ** attempt, 30))
+
+def _copy_body(r: requests.Response, dst_path: str):
+    # copy straight off the socket in 8 MiB reads; decode_content still
+    # honours a server that ignores identity and gzips anyway
+    r.raw.decode_content = True
+    with open(dst_path, "wb") as f:
+        shutil.copyfileobj(r.raw, f, length=8 * MB)
+
+def _download_whole(url: str, dst_path: str):
+    """Single-stream fetch, no Range."""
+    with http_session.get(url, stream=True, timeout=REQUEST_TIMEOUT,
+                          headers={"Accept-Encoding": "identity"}) as r:
+        r.raise_for_status()
+        _copy_body(r, dst_path)
 
 def _download(url: str, dst_path: str):
+    """Fetch url to dst_path. The first request asks for one part by Range; if
+    the server honours it, the remaining parts are fetched in parallel and
+    pwrite()n into a pre-sized file. Servers that ignore Range send the whole
+    body (200) on that same request, which is then streamed as before."""
     app.logger.info("⬇️  downloading %s", url)
-    with requests.get(url, stream=True, timeout=REQUEST_TIMEOUT, headers=HEADERS) as r:
+    part = DOWNLOAD_PART_MB * MB
+    # mp4 bodies don't compress; skip gzip negotiation and decode work
+    hdrs = {"Accept-Encoding": "identity", "Range": f"bytes=0-{part - 1}"}
+    with http_session.get(url, stream=True, timeout=REQUEST_TIMEOUT, headers=hdrs) as r:
         r.raise_for_status()
-        with open(dst_path, "wb") as f:
-            for chunk in r.iter_content(1024 * 1024):
-                if chunk:
-                    f.write(chunk)
+        if r.status_code != 206:
+            _copy_body(r, dst_path)
+            return
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+        if not total.isdigit():
+            # 206 with an unknown total ("*"): no way to plan the parts
+            r.close()
+            app.logger.info("Range total unknown; downloading in one stream")
+            _download_whole(url, dst_path)
+            return
+        size, final_url, etag = int(total), r.url, r.headers.get("ETag")
+        if etag and etag.startswith("W/"):
+            etag = None  # If-Range needs a strong validator; a weak one forces 200s
+        fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, "posix_fallocate") and size:
+                os.posix_fallocate(fd, 0, size)
+            off = _pwrite_stream(r.raw, fd, 0)
+            if off != min(part, size):
+                raise requests.ConnectionError(f"short first range: got {off} bytes")
+            r.close()
+            ranges = [(lo, min(lo + part, size) - 1) for lo in range(part, size, part)]
+            if ranges:
+                # own pool: _download itself usually runs on io_pool
+                with ThreadPoolExecutor(max_workers=min(DOWNLOAD_CONCURRENCY, len(ranges)),
+                                        thread_name_prefix="range") as pool:
+                    jobs = [pool.submit(_download_range, final_url, fd, lo, hi, etag) for lo, hi in ranges]
+                    for j in jobs:
+                        j.result()
+        except _RangeUnsupported as e:
+            # origin stopped honouring Range (or the object changed): start over whole
+            app.logger.warning("%s; downloading in one stream", e)
+            os.close(fd)
+            fd = -1
+            _download_whole(url, dst_path)
+        finally:
+            if fd >= 0:
+                os.close(fd)
 
 def s3_download(bucket: str, key: str, dst_path: str):
     app.logger.info("Downloading overlay from s3://%s/%s", bucket, key)
-    s3.download_file(bucket, key, dst_path)
+    s3.download_file(bucket, key, dst_path, Config=S3_TRANSFER)
 
-def s3_upload(src_path: str, bucket: str, key: str) -> str:
-    extra = {}
+@functools.lru_cache(maxsize=8)
+def _sigv4_signing_key(secret_key: str, datestamp: str, region: str, service: str) -> bytes:
+    """kDate -> kRegion -> kService -> kSigning; valid for the whole UTC day."""
+    k = hmac.new(("AWS4" + secret_key).encode(), datestamp.encode(), hashlib.sha256).digest()
+    for part in (region, service, "aws4_request"):
+        k = hmac.new(k, part.encode(), hashlib.sha256).digest()
+    return k
+
+# The hand-rolled signer below targets the default regional host; only use it
+# when the client talks to that endpoint (not AWS_ENDPOINT_URL[_S3], FIPS, ...).
+_PRESIGN_FAST = s3.meta.endpoint_url in (
+    f"https://s3.{AWS_REGION}.amazonaws.com",
+    *(("https://s3.amazonaws.com",) if AWS_REGION == "us-east-1" else ()),
+)
+
+def presign_get(bucket: str, key: str, expires: int) -> str:
+    """SigV4 query-string presigned GET URL, reusing the cached per-day signing key."""
+    creds = session.get_credentials()
+    if creds is None or "." in bucket or not _PRESIGN_FAST:
+        # dotted bucket names can't use virtual-host TLS, and custom/FIPS/
+        # dualstack endpoints aren't the host below; let botocore pick
+        return s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=expires
+        )
+    c = creds.get_frozen_credentials()
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    datestamp = amz_date[:8]
+    scope = f"{datestamp}/{AWS_REGION}/s3/aws4_request"
+    host = f"{bucket}.s3.{AWS_REGION}.amazonaws.com"
+    params = {
+        "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+        "X-Amz-Credential": f"{c.access_key}/{scope}",
+        "X-Amz-Date": amz_date,
+        "X-Amz-Expires": str(expires),
+        "X-Amz-SignedHeaders": "host",
+    }
+    if c.token:
+        params["X-Amz-Security-Token"] = c.token
+    query = "&".join(f"{quote(k, safe='~')}={quote(v, safe='~')}" for k, v in sorted(params.items()))
+    path = "/" + quote(key, safe="/~")
+    canonical = f"GET\n{path}\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+    to_sign = f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n{hashlib.sha256(canonical.encode()).hexdigest()}"
+    signing_key = _sigv4_signing_key(c.secret_key, datestamp, AWS_REGION, "s3")
+    signature = hmac.new(signing_key, to_sign.encode(), hashlib.sha256).hexdigest()
+    return f"https://{host}{path}?{query}&X-Amz-Signature={signature}"
+
+def _upload_extra_args() -> dict:
+    # typed + cacheable so players/CDNs don't refetch or sniff
+    extra = {"ContentType": "video/mp4"}
+    if OUTPUT_CACHE_CONTROL:
+        extra["CacheControl"] = OUTPUT_CACHE_CONTROL
     if MAKE_PUBLIC:
         extra["ACL"] = "public-read"
-    size_mb = os.path.getsize(src_path) / 1e6
-    app.logger.info("⬆️  uploading to s3://%s/%s (%.2f MB)", bucket, key, size_mb)
-    s3.upload_file(src_path, bucket, key, ExtraArgs=extra)
+    return extra
+
+def _file_md5(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            # one front-to-back pass: bigger readahead when scratch isn't tmpfs
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for block in iter(lambda: f.read(8 * MB), b""):
+            h.update(block)
+    return h.hexdigest()
 
+def _stored_md5(bucket: str, key: str) -> Optional[str]:
+    try:
+        return s3.head_object(Bucket=bucket, Key=key).get("Metadata", {}).get("md5")
+    except (ClientError, BotoCoreError):
+        return None  # can't tell; just upload
+
+def s3_upload(src_path: str, bucket: str, key: str) -> str:
+    size = os.path.getsize(src_path)
+    # Multipart ETags aren't content MD5s, so the digest rides along as
+    # metadata; a re-render that produced identical bytes skips the PUT.
+    # HEAD on this thread: io_pool can be full of long source downloads, and
+    # one round trip is noise next to the MD5 pass anyway.
+    md5 = _file_md5(src_path)
+    if _stored_md5(bucket, key) == md5:
+        app.logger.info("⏭️  s3://%s/%s already holds this render; skipping upload", bucket, key)
+        return _output_url(bucket, key)
+    app.logger.info("⬆️  uploading to s3://%s/%s (%.2f MB)", bucket, key, size / 1e6)
+    # per-part CRC32 is verified by S3, so a corrupted part fails the upload
+    extra = {**_upload_extra_args(), "Metadata": {"md5": md5}, "ChecksumAlgorithm": "CRC32"}
+    s3.upload_file(src_path, bucket, key, ExtraArgs=extra, Config=_upload_transfer_config(size))
+    return _output_url(bucket, key)
+
+def s3_upload_stream(fileobj, bucket: str, key: str) -> str:
+    app.logger.info("⬆️  streaming upload to s3://%s/%s", bucket, key)
+    s3.upload_fileobj(fileobj, bucket, key, ExtraArgs=_upload_extra_args(), Config=S3_TRANSFER)
+    return _output_url(bucket, key)
+
+# public URL prefix for the output bucket, fixed for the process lifetime
+_PUBLIC_URL_BASE = PUBLIC_BASE_URL or f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com"
+
+def _output_url(bucket: str, key: str) -> str:
     # Choose URL to return
     if MAKE_PUBLIC:
-        return f"https://{bucket}.s3.{AWS_REGION}.amazonaws.com/{key}"
+        base = _PUBLIC_URL_BASE if bucket == S3_BUCKET else f"https://{bucket}.s3.{AWS_REGION}.amazonaws.com"
+        return f"{base}/{quote(key, safe='/~')}"
     if PRESIGN_TTL > 0:
-        return s3.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket, "Key": key},
-            ExpiresIn=PRESIGN_TTL
-        )
+        return presign_get(bucket, key, PRESIGN_TTL)
     return f"s3://{bucket}/{key}"
 
 def ffprobe_meta(path: str) -> dict:
+    """Stream meta for a local file or URL. Local files are memoized on
+    (path, mtime, size), so re-probing the same staged file is free."""
     try:
+        st = os.stat(path)
+    except OSError:
+        return _ffprobe(path)  # URL (or missing file): always probe
+    return _ffprobe_cached(path, st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=256)
+def _ffprobe_cached(path: str, mtime_ns: int, size: int) -> dict:
+    return _ffprobe(path)
+
+# ffmpeg's HTTP protocol blocks forever on a stalled socket by default; give
+# URL inputs the same I/O timeout as our own requests (microseconds).
+_RW_TIMEOUT = ("-rw_timeout", str(REQUEST_TIMEOUT * 1_000_000))
+
+def _ffprobe(path: str) -> dict:
+    try:
+        # MP4 stream info lives in the moov box; a 0.5 MB / 0.5 s cap keeps
+        # ffprobe from analysing (and, for URLs, downloading) far past it
         cmd = [
-            F F P R O B E := FFPROBE_BIN, "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height,avg_frame_rate",
+            FFPROBE_BIN, "-v", "error", "-probesize", "500000", "-analyzeduration", "500000",
+            "-show_entries", "stream=codec_type,codec_name,pix_fmt,width,height,avg_frame_rate,r_frame_rate",
             "-of", "json", path
         ]
-        code, out = _run(cmd)
-        if code == 0:
-            data = json.loads(out)
-            st = data.get("streams", [{}])[0]
-            fps = st.get("avg_frame_rate", "0/1")
+        if path.startswith(("http://", "https://")):
+            # same UA as the render's own input, or UA-filtering origins fail
+            # the probe and every render loses its stream-copy shortcut
+            cmd[3:3] = ("-user_agent", HEADERS["User-Agent"], *_RW_TIMEOUT)
+        # raw stdout bytes straight into orjson; stderr isn't needed here. A
+        # stalled origin raises TimeoutExpired -> {} instead of pinning a worker.
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                           timeout=REQUEST_TIMEOUT * 2)
+        if p.returncode == 0:
+            streams = orjson.loads(p.stdout).get("streams", [])
+            st = next((x for x in streams if x.get("codec_type") == "video"), {})
+            audio = next((x for x in streams if x.get("codec_type") == "audio"), {})
+            # avg_frame_rate is 0/0 on some VFR muxes; r_frame_rate comes in the same call
+            fps = st.get("avg_frame_rate", "0/0")
+            if fps in ("0/0", "0/1"):
+                fps = st.get("r_frame_rate", "0/1")
+            # unknown stays None: guessing TARGET_FPS here would skip the fps
+            # filter and allow stream copy for a source of unknown rate
             try:
                 n, d = fps.split("/")
-                fps_val = round(float(n) / float(d), 3) if float(d) != 0 else TARGET_FPS
+                fps_val = round(float(n) / float(d), 3) if float(n) > 0 and float(d) > 0 else None
             except Exception:
-                fps_val = TARGET_FPS
-            return {"width": st.get("width"), "height": st.get("height"), "fps": fps_val}
+                fps_val = None
+            return {
+                "width": st.get("width"), "height": st.get("height"), "fps": fps_val,
+                "codec": st.get("codec_name"), "pix_fmt": st.get("pix_fmt"),
+                "audio_codec": audio.get("codec_name"),
+            }
     except Exception:
         pass
     return {}
@@ -134,30 +471,118 @@ def ffprobe_meta(path: str) -> dict:
 # ──────────────────────────────────────────────────────────────────────────────
 # MP4 resolution (microsite HTML + retries + /location fallback)
 # ──────────────────────────────────────────────────────────────────────────────
-MP4_RE = re.compile(r'https?://[^"\']+\.mp4[^"\']*', re.I)
-
-def _scrape_mp4_from_html(html: str) -> Optional[str]:
-    cands = []
-    # 1) any .mp4 string
-    cands += MP4_RE.findall(html)
-    # 2) <source>/<video> tags
-    cands += re.findall(r'src=["\'](https?://[^"\']+\.mp4[^"\']*)', html, re.I)
-    # 3) OpenGraph
-    cands += re.findall(r'property=["\']og:video["\']\s+content=["\'](https?://[^"\']+\.mp4[^"\']*)', html, re.I)
-    # 4) JSON strings containing .mp4
-    cands += re.findall(r'"(https?://[^"]+\.mp4[^"]*)"', html, re.I)
-    return cands[0] if cands else None
+# Bounded, whitespace/quote-delimited URL path: keeps the scan linear on large
+# pages with many non-mp4 links instead of backtracking across the whole text.
+# The query is left unbounded (a trailing greedy class is still linear) so long
+# signed URLs (STS session tokens) are matched whole, never truncated.
+_URL_CHARS   = r'[^\s"\'<>]'
+MP4_URL      = rf'https?://{_URL_CHARS}{{1,2048}}\.mp4(?:[?#]{_URL_CHARS}*)?'
+
+MP4_BYTES_RE = re.compile(MP4_URL.encode(), re.I)   # raw request bodies, no decode
+
+# Pages are scanned in chunks; the overlap must exceed the longest MP4_URL
+# match up to ".mp4" so a URL straddling two chunks is still seen whole. A hit
+# whose query runs into the next chunk is carried over from its start instead.
+SCAN_CHUNK   = 64 * 1024
+SCAN_OVERLAP = 2100
+
+def _scrape_mp4_from_stream(chunks) -> Optional[str]:
+    """Scan an HTML byte stream chunk by chunk, stopping at the first complete hit.
+
+    One MP4_BYTES_RE pass covers <source>/<video> src, og:video and JSON strings
+    alike: each of those is itself an MP4_URL match, so the first match in
+    document order is the same URL the per-form patterns would have found.
+    Chunks are matched as raw bytes; only the winning URL is decoded.
+    """
+    tail = b""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        window = tail + chunk
+        # cheap C-level substring prefilter; the regex only runs on windows
+        # that can actually contain a match
+        m = MP4_BYTES_RE.search(window) if b".mp4" in window.lower() else None
+        # a hit touching the end of the window may be cut mid-URL; read on,
+        # keeping the whole hit (a run longer than a chunk isn't a URL)
+        if m and m.end() < len(window):
+            return m.group(0).decode("utf-8", "ignore")
+        if m and len(window) - m.start() <= SCAN_CHUNK:
+            tail = window[m.start():]
+        else:
+            tail = window[-SCAN_OVERLAP:]
+    m = MP4_BYTES_RE.search(tail) if b".mp4" in tail.lower() else None
+    return m.group(0).decode("utf-8", "ignore") if m else None
+
+# Top-level webhook fields, in preference order
+DIRECT_MP4_KEYS  = ("mp4_url", "video_url")
+PAGE_URL_KEYS    = ("media_url", "image_url")
+PAYLOAD_URL_KEYS = frozenset(DIRECT_MP4_KEYS + PAGE_URL_KEYS)
+
+def _payload_urls(payload: dict) -> dict:
+    """Single pass over top-level keys: string values of known URL fields, keyed lowercase."""
+    urls = {}
+    for k, v in payload.items():
+        if type(v) is str and isinstance(k, str):
+            kl = k.lower()
+            if kl in PAYLOAD_URL_KEYS:
+                urls[kl] = v
+    return urls
+
+def _is_mp4_url(s: str) -> bool:
+    # path ends in .mp4, query (signed URLs) ignored; partition avoids split's list
+    return s.lower().partition("?")[0].endswith(".mp4")
+
+def _find_mp4_in_obj(obj) -> Optional[str]:
+    """Depth-first search of parsed JSON for an .mp4 URL (explicit stack, no recursion)."""
+    stack = [obj]
+    while stack:
+        cur = stack.pop()
+        t = type(cur)
+        if t is dict:
+            # direct fields: url/mime or similar
+            u = cur.get("url") or cur.get("href") or cur.get("download_url")
+            m = cur.get("mime") or cur.get("content_type") or cur.get("type")
+            if u and isinstance(u, str) and _is_mp4_url(u):
+                return u
+            if m and "mp4" in str(m).lower() and u and isinstance(u, str):
+                return u
+            # reversed so children are visited in document order
+            stack.extend(reversed(list(cur.values())))
+        elif t is list:
+            stack.extend(reversed(cur))
+        elif t is str:
+            if _is_mp4_url(cur):
+                return cur
+    return None
+
+def _mp4_reachable(url: str) -> bool:
+    """HEAD-probe a scraped candidate so a page that links a not-yet-published
+    video goes back to the retry loop instead of failing later in ffmpeg.
+    Only a definite miss rejects: presigned GET URLs answer HEAD with 403 and
+    some origins don't do HEAD at all, so anything unclear is accepted."""
+    try:
+        r = loop_session.head(url, timeout=5, allow_redirects=True)
+    except requests.RequestException:
+        return True
+    if r.status_code in (404, 410):
+        return False
+    ctype = r.headers.get("Content-Type", "").lower()
+    return r.status_code >= 400 or not ctype.startswith("text/")
 
 def resolve_mp4_from_page(url: str, tries: int = RESOLVE_TRIES, sleep_sec: float = RESOLVE_SLEEP_SEC) -> Optional[str]:
     app.logger.info("🔎 resolving MP4 from page: %s", url)
 
     def try_once(u: str) -> Optional[str]:
-        r = _fetch(u)
-        r.raise_for_status()
-        # if redirect landed on .mp4
-        if r.url.lower().endswith(".mp4"):
-            return r.url
-        return _scrape_mp4_from_html(r.text)
+        with _fetch(u, stream=True) as r:
+            r.raise_for_status()
+            # if redirect landed on .mp4 (don't pull the video body)
+            if _is_mp4_url(r.url):
+                return r.url
+            hit = _scrape_mp4_from_stream(r.iter_content(SCAN_CHUNK))
+        if hit and not _mp4_reachable(hit):
+            app.logger.info("⏳ candidate not served yet: %s", hit)
+            return None
+        return hit
 
     for attempt in range(1, tries + 1):
         try:
@@ -178,6 +603,7 @@ def resolve_mp4_from_page(url: str, tries: int = RESOLVE_TRIES, sleep_sec: float
 
         if attempt < tries:
             time.sleep(sleep_sec)
+            sleep_sec *= 1.5
     return None
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -195,46 +621,21 @@ def breeze_api_find_mp4(session_id: Optional[str], gallery_id: Optional[str]) ->
     }
     try:
         app.logger.info("🛰️  Breeze API lookup: %s", url)
-        r = requests.get(url, headers=hdrs, timeout=REQUEST_TIMEOUT)
+        r = http_session.get(url, headers=hdrs, timeout=REQUEST_TIMEOUT)
         r.raise_for_status()
-        text = r.text or ""
+        body = r.content
         # Try to parse JSON; if structure unknown, still search for .mp4
         mp4 = None
         try:
-            data = r.json()
-            # VERY generic walkers: look for common fields or scan strings
-            # 1) Lists of dicts with url/mime or similar
-            def walk(obj):
-                nonlocal mp4
-                if mp4:
-                    return
-                if isinstance(obj, dict):
-                    # direct fields
-                    u = obj.get("url") or obj.get("href") or obj.get("download_url")
-                    m = obj.get("mime") or obj.get("content_type") or obj.get("type")
-                    if u and isinstance(u, str) and u.lower().endswith(".mp4"):
-                        mp4 = u
-                        return
-                    if m and "mp4" in str(m).lower() and u:
-                        mp4 = u
-                        return
-                    for v in obj.values():
-                        walk(v)
-                elif isinstance(obj, list):
-                    for v in obj:
-                        walk(v)
-                elif isinstance(obj, str):
-                    if obj.lower().endswith(".mp4"):
-                        mp4 = obj
-            walk(data)
-        except Exception:
+            mp4 = _find_mp4_in_obj(orjson.loads(body))
+        except orjson.JSONDecodeError:
             pass
 
         if not mp4:
-            # fallback: regex on raw JSON/text
-            mp = MP4_RE.search(text)
+            # fallback: regex on the raw bytes (only decoded on a hit)
+            mp = MP4_BYTES_RE.search(body)
             if mp:
-                mp4 = mp.group(0)
+                mp4 = mp.group(0).decode("utf-8", "ignore")
         if mp4:
             app.logger.info("🛰️  Breeze API mp4: %s", mp4)
         return mp4
@@ -245,46 +646,327 @@ def breeze_api_find_mp4(session_id: Optional[str], gallery_id: Optional[str]) ->
 # ──────────────────────────────────────────────────────────────────────────────
 # FFmpeg pipeline
 # ──────────────────────────────────────────────────────────────────────────────
-def maybe_download_overlay(workdir: str) -> Optional[str]:
+# The overlay key is fixed for the process: keep one local copy and only
+# re-validate it (HEAD/ETag) every OVERLAY_REFRESH_SEC.
+OVERLAY_CACHE_DIR = os.path.join(tempfile.gettempdir(), "cloud-renderer-overlay")
+_overlay_lock = threading.Lock()
+_overlay_cache = {"path": None, "etag": None, "checked": 0.0}
+
+def maybe_download_overlay() -> Optional[str]:
     if not OVERLAY_S3_KEY:
         app.logger.info("No OVERLAY_S3_KEY set; skipping overlay.")
         return None
-    local = os.path.join(workdir, os.path.basename(OVERLAY_S3_KEY))
+    with _overlay_lock:
+        path = _overlay_cache["path"]
+        have = bool(path and os.path.exists(path))
+        now = time.time()
+        if have and now - _overlay_cache["checked"] < OVERLAY_REFRESH_SEC:
+            return path
+        try:
+            etag = s3.head_object(Bucket=S3_BUCKET, Key=OVERLAY_S3_KEY).get("ETag")
+            if not (have and etag == _overlay_cache["etag"]):
+                os.makedirs(OVERLAY_CACHE_DIR, exist_ok=True)
+                path = os.path.join(OVERLAY_CACHE_DIR, os.path.basename(OVERLAY_S3_KEY))
+                # download beside it and swap in atomically; renders already
+                # reading the old file keep their open inode. The lock is
+                # per-process, so each gunicorn worker stages under its own name.
+                fd, tmp = tempfile.mkstemp(dir=OVERLAY_CACHE_DIR, suffix=".part")
+                os.close(fd)
+                try:
+                    s3_download(S3_BUCKET, OVERLAY_S3_KEY, tmp)
+                    os.replace(tmp, path)
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(tmp)
+                    raise
+            _overlay_cache.update(path=path, etag=etag, checked=now)
+            return path
+        except (ClientError, BotoCoreError, OSError) as e:
+            app.logger.warning("Overlay download failed: %s", e)
+            # a stale overlay beats none
+            return path if have else None
+
+if OVERLAY_S3_KEY:
+    io_pool.submit(maybe_download_overlay)  # warm the cache without blocking import
+
+HW_H264_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_vaapi", "h264_videotoolbox")
+# decode-side hwaccel to pair with each encoder (vaapi sets up its own device)
+_HWACCEL_DECODE = {"h264_nvenc": "cuda", "h264_qsv": "qsv", "h264_videotoolbox": "videotoolbox"}
+
+def detect_h264_encoder() -> str:
+    """Pick a hardware H.264 encoder if this ffmpeg build has one, else libx264."""
+    if H264_ENCODER != "auto":
+        return H264_ENCODER
     try:
-        s3_download(S3_BUCKET, OVERLAY_S3_KEY, local)
-        return local
-    except (ClientError, BotoCoreError) as e:
-        app.logger.warning("Overlay download failed: %s", e)
-        return None
+        p = subprocess.run([FFMPEG_BIN, "-hide_banner", "-encoders"],
+                           capture_output=True, text=True, timeout=10)
+        for enc in HW_H264_ENCODERS:
+            if enc == "h264_vaapi" and not os.path.exists(VAAPI_DEVICE):
+                continue
+            # distro builds list nvenc/qsv on hosts without the hardware;
+            # only trust an encoder that can actually encode a frame
+            if f" {enc} " in p.stdout and _encoder_works(enc):
+                return enc
+    except Exception:
+        pass
+    return "libx264"
 
-def compose_with_ffmpeg(src_mp4: str, out_mp4: str, overlay: Optional[str]):
-    if overlay:
-        # Alpha-aware overlay, keep base size, stop at shortest stream
-        filtergraph = "[0:v]format=rgba[base];[1:v]format=rgba[ol];[base][ol]overlay=0:0:format=auto:shortest=1[vout]"
-        cmd = [
-            FFMPEG_BIN, "-y", "-loglevel", "error",
-            "-i", src_mp4, "-i", overlay,
-            "-filter_complex", filtergraph,
+def _encoder_works(enc: str) -> bool:
+    """1-frame null encode; fails fast when the device or driver is absent."""
+    if enc == "h264_vaapi":
+        args = ("-vaapi_device", VAAPI_DEVICE, "-f", "lavfi", "-i", "nullsrc=s=256x256",
+                "-vf", "format=nv12,hwupload")
+    else:
+        args = ("-f", "lavfi", "-i", "nullsrc=s=256x256")
+    try:
+        p = subprocess.run([FFMPEG_BIN, "-hide_banner", "-loglevel", "error", *args,
+                            "-frames:v", "1", "-c:v", enc, "-f", "null", "-"],
+                           capture_output=True, timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return p.returncode == 0
+
+def _encode_tail(encoder: str, gpu_frames: bool = False) -> tuple:
+    if encoder == "libx264":
+        rate = ("-qp", X264_QP) if X264_QP else ("-crf", X264_CRF)
+        vcodec = ("-c:v", "libx264", "-preset", X264_PRESET, *rate)
+        if X264_TUNE:
+            vcodec += ("-tune", X264_TUNE)
+        if X264_PARAMS:
+            vcodec += ("-x264-params", X264_PARAMS)
+    elif encoder == "h264_nvenc":
+        # constant-quality VBR (-b:v 0 lets -cq drive), peak-capped for players
+        vcodec = ("-c:v", encoder, "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "22",
+                  "-b:v", "0", "-maxrate", "6M", "-bufsize", "12M")
+    elif encoder == "h264_qsv":
+        vcodec = ("-c:v", encoder, "-preset", "veryfast", "-global_quality", "23")
+    else:
+        vcodec = ("-c:v", encoder)
+    # VAAPI/CUDA graphs hand the encoder GPU surfaces, so no -pix_fmt
+    pix_fmt = () if encoder == "h264_vaapi" or gpu_frames else ("-pix_fmt", "yuv420p")
+    # -r stays as a cap; the graphs already hand over frames at TARGET_FPS
+    return (
+        *vcodec, *pix_fmt,
+        "-r", str(TARGET_FPS),
+    )
+
+def _audio_args(audio_codec: Optional[str]) -> tuple:
+    """audio_codec as probed: None = no audio stream, "" = not probed."""
+    if audio_codec is None:
+        return ("-an",)  # probed silent: skip audio setup entirely
+    # AAC sources (nearly all MP4s) are copied; anything else is transcoded
+    if audio_codec == "aac":
+        return ("-c:a", "copy")
+    return ("-c:a", "aac", "-b:a", "128k")
+
+# Encode args are process-lifetime constants; build them once at import.
+VIDEO_ENCODER = detect_h264_encoder()
+app.logger.info("H.264 encoder: %s", VIDEO_ENCODER)
+# Base stays YUV; only the overlay carries alpha (yuva420p), so there is no
+# per-frame yuv->rgba->yuv round trip of the full base picture. Frames are
+# dropped to TARGET_FPS first, so the blend only runs on frames that are kept
+# (-r on the output alone would overlay every source frame, then discard).
+# Sources already at TARGET_FPS skip the fps node altogether.
+_FPS_FILTER = f"fps={TARGET_FPS}"
+_OVERLAY_FILTERGRAPH = "[1:v]format={ol_fmt}[ol];{main}[ol]overlay=0:0:format=auto:shortest=1"
+# pix_fmt prefixes that never carry alpha; anything else (or unknown) blends
+_OPAQUE_PIX_FMTS = ("yuv4", "yuvj", "rgb24", "bgr24", "rgb48", "gray", "nv12", "nv21")
+
+def _overlay_has_alpha(overlay: str) -> bool:
+    # ffprobe_meta is memoized per file, so this costs one probe per overlay version
+    pix = ffprobe_meta(overlay).get("pix_fmt") or ""
+    return not (pix.startswith(_OPAQUE_PIX_FMTS) and "a" not in pix.replace("gray", ""))
+
+def _has_ffmpeg_filters(*names: str) -> bool:
+    try:
+        p = subprocess.run([FFMPEG_BIN, "-hide_banner", "-filters"],
+                           capture_output=True, text=True, timeout=10)
+    except Exception:
+        return False
+    return all(f" {n} " in p.stdout for n in names)
+
+_VAAPI_UPLOAD = "format=nv12,hwupload"
+_CMD_HEAD = (FFMPEG_BIN, "-y", "-loglevel", "error")
+_ENCODE_TAILS = {enc: _encode_tail(enc) for enc in {VIDEO_ENCODER, "libx264"}}
+# every (overlay has alpha, vaapi, fps change) variant of the composite graph, prebuilt
+_OVERLAY_GRAPHS = {
+    (alpha, vaapi, resample): (f"[0:v]{_FPS_FILTER}[base];" if resample else "")
+        + _OVERLAY_FILTERGRAPH.format(ol_fmt="yuva420p" if alpha else "yuv420p",
+                                      main="[base]" if resample else "[0:v]")
+        + (f",{_VAAPI_UPLOAD}[vout]" if vaapi else "[vout]")
+    for alpha in (True, False) for vaapi in (True, False) for resample in (True, False)
+}
+
+# NVENC builds with the CUDA filters composite in VRAM: NVDEC frames are
+# fps-dropped, converted to yuv420p (overlay_cuda won't mix nv12 with alpha)
+# and blended on the GPU, then encoded without ever returning to system memory.
+CUDA_OVERLAY = VIDEO_ENCODER == "h264_nvenc" and _has_ffmpeg_filters("overlay_cuda", "scale_cuda")
+_CUDA_HEAD = (*_CMD_HEAD,
+              "-init_hw_device", "cuda=gpu", "-filter_hw_device", "gpu",
+              "-hwaccel", "cuda", "-hwaccel_device", "gpu", "-hwaccel_output_format", "cuda")
+_CUDA_OVERLAY_FILTERGRAPH = (f"[0:v]{_FPS_FILTER},scale_cuda=format=yuv420p[base];"
+                             "[1:v]format={ol_fmt},hwupload[ol];"
+                             "[base][ol]overlay_cuda=x=0:y=0:shortest=1[vout]")
+_CUDA_TAIL = _encode_tail("h264_nvenc", gpu_frames=True)
+if CUDA_OVERLAY:
+    app.logger.info("Overlay compositing on CUDA")
+
+def _input_args(src: str) -> tuple:
+    """-i args; remote sources are read by ffmpeg over HTTP (seeks via Range)."""
+    if src.startswith(("http://", "https://")):
+        # resume dropped connections instead of failing the render, and keep
+        # one persistent connection for the moov/mdat seeks
+        return ("-user_agent", HEADERS["User-Agent"], *_RW_TIMEOUT,
+                "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+                "-multiple_requests", "1", "-i", src)
+    return ("-i", src)
+
+def _output_args(out_mp4: str) -> tuple:
+    if out_mp4 == "pipe:1":
+        # stdout can't seek back to write moov up front; emit fragmented MP4
+        return ("-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", out_mp4)
+    return ("-movflags", "+faststart", out_mp4)
+
+# Renders currently running. Each ffmpeg gets an equal share of this worker's
+# cores (cpu_count / WEB_CONCURRENCY), so a burst of webhooks across gunicorn
+# workers doesn't leave N ffmpegs each spawning one thread per core. The count
+# is per process: an idle worker's share isn't lent to a busy one.
+_inflight = 0
+_inflight_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _counted_render():
+    global _inflight
+    with _inflight_lock:
+        _inflight += 1
+    try:
+        yield
+    finally:
+        with _inflight_lock:
+            _inflight -= 1
+
+def _render_threads() -> str:
+    if X264_THREADS != "0":
+        return X264_THREADS
+    return str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY // max(1, _inflight)))
+
+def _compose_cmd(src_mp4: str, out_mp4: str, overlay: Optional[str], encoder: str,
+                 audio_codec: Optional[str] = "", src_fps: Optional[float] = None) -> list[str]:
+    vaapi = encoder == "h264_vaapi"
+    resample = not (src_fps and abs(src_fps - TARGET_FPS) < 0.01)
+    threads = _render_threads()
+    if vaapi:
+        head = (*_CMD_HEAD, "-vaapi_device", VAAPI_DEVICE)
+    elif encoder in _HWACCEL_DECODE:
+        # GPU decode on the encoder's vendor; frames come back to system memory
+        # for the CPU overlay. (the libx264 retry builds its command without this)
+        head = (*_CMD_HEAD, "-hwaccel", _HWACCEL_DECODE[encoder])
+    else:
+        head = _CMD_HEAD
+    # hardware encoders don't take a CPU thread budget
+    enc_threads = ("-threads", threads) if encoder == "libx264" else ()
+    if overlay and encoder == "h264_nvenc" and CUDA_OVERLAY:
+        alpha = _overlay_has_alpha(overlay)
+        return [
+            *_CUDA_HEAD,
+            *_input_args(src_mp4), "-i", overlay,
+            "-filter_complex", _CUDA_OVERLAY_FILTERGRAPH.format(ol_fmt="yuva420p" if alpha else "yuv420p"),
             "-map", "[vout]", "-map", "0:a?",
-            "-c:v", "libx264", "-pix_fmt", "yuv420p",
-            "-r", str(TARGET_FPS),
-            "-movflags", "+faststart",
-            "-c:a", "aac", "-b:a", "128k",
-            out_mp4
+            *_CUDA_TAIL, *_audio_args(audio_codec),
+            *_output_args(out_mp4)
         ]
-    else:
-        cmd = [
-            FFMPEG_BIN, "-y", "-loglevel", "error",
-            "-i", src_mp4,
-            "-c:v", "libx264", "-pix_fmt", "yuv420p",
-            "-r", str(TARGET_FPS),
-            "-movflags", "+faststart",
-            "-c:a", "aac", "-b:a", "128k",
-            out_mp4
+    if overlay:
+        # Alpha-aware overlay, keep base size, stop at shortest stream. An
+        # opaque overlay stays yuv420p: no alpha plane, plain copy instead of a blend.
+        graph = _OVERLAY_GRAPHS[(_overlay_has_alpha(overlay), vaapi, resample)]
+        return [
+            *head, "-filter_complex_threads", threads,
+            *_input_args(src_mp4), "-i", overlay,
+            "-filter_complex", graph,
+            "-map", "[vout]", "-map", "0:a?",
+            *_ENCODE_TAILS[encoder], *enc_threads, *_audio_args(audio_codec),
+            *_output_args(out_mp4)
         ]
-    code, out = _run(cmd)
+    chain = ",".join(f for f, on in ((_FPS_FILTER, resample), (_VAAPI_UPLOAD, vaapi)) if on)
+    vf = ("-vf", chain) if chain else ()
+    return [*head, *_input_args(src_mp4), *vf, *_ENCODE_TAILS[encoder], *enc_threads,
+            *_audio_args(audio_codec), *_output_args(out_mp4)]
+
+def _can_stream_copy(meta: dict) -> bool:
+    """Source already matches the output format (H.264/yuv420p at TARGET_FPS)."""
+    return (
+        meta.get("codec") == "h264"
+        and meta.get("pix_fmt") == "yuv420p"
+        and abs((meta.get("fps") or 0) - TARGET_FPS) < 0.01
+    )
+
+def compose_with_ffmpeg(src_mp4: str, out_mp4: str, overlay: Optional[str],
+                        meta: Optional[dict] = None) -> dict:
+    """Render src_mp4 to out_mp4; returns output meta (width/height/fps).
+    Pass `meta` when the source was already probed (e.g. during its download)."""
+    # Probe the source once up front. Neither path scales, so the output keeps
+    # the source geometry and only fps changes; no post-encode ffprobe needed.
+    meta = meta or ffprobe_meta(src_mp4)
+    if not overlay and _can_stream_copy(meta):
+        # Nothing to composite or convert: remux only (moves moov up front)
+        code, out = _run([*_CMD_HEAD, *_input_args(src_mp4), "-c", "copy", *_output_args(out_mp4)])
+        if code == 0 and os.path.exists(out_mp4):
+            return meta
+        app.logger.warning("Stream copy failed (code %s); transcoding", code)
+
+    code, out = _run(_compose_cmd(src_mp4, out_mp4, overlay, VIDEO_ENCODER,
+                                  meta.get("audio_codec", ""), meta.get("fps")))
+    if code != 0 and VIDEO_ENCODER != "libx264":
+        # encoder is compiled in but the device may be absent/busy
+        app.logger.warning("%s encode failed (code %s); retrying with libx264", VIDEO_ENCODER, code)
+        code, out = _run(_compose_cmd(src_mp4, out_mp4, overlay, "libx264",
+                                      meta.get("audio_codec", ""), meta.get("fps")))
     if code != 0 or not os.path.exists(out_mp4):
         raise RuntimeError(f"ffmpeg failed (code {code})\n{out}")
+    return {**meta, "fps": TARGET_FPS, "codec": "h264", "pix_fmt": "yuv420p"}
+
+def _stream_cmd_to_s3(cmd: list[str], bucket: str, key: str) -> str:
+    """Run an ffmpeg command writing to pipe:1 and upload its stdout; returns the URL."""
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("FFmpeg cmd: %s", " ".join(cmd))
+    # stderr goes to a file so it can never back up and stall the stdout pipe
+    with tempfile.TemporaryFile() as err:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        try:
+            url = s3_upload_stream(p.stdout, bucket, key)
+        finally:
+            p.stdout.close()
+            code = p.wait()
+        if code != 0:
+            try:
+                s3.delete_object(Bucket=bucket, Key=key)  # don't leave a truncated render behind
+            except (ClientError, BotoCoreError):
+                pass
+            err.seek(0)
+            raise RuntimeError(f"ffmpeg failed (code {code})\n{err.read().decode('utf-8', 'ignore')}")
+    return url
+
+def compose_to_s3(src_mp4: str, overlay: Optional[str], bucket: str, key: str,
+                  meta: Optional[dict] = None) -> Tuple[dict, str]:
+    """Render straight into an S3 multipart upload from ffmpeg's stdout; returns (meta, url)."""
+    meta = meta or ffprobe_meta(src_mp4)
+    if not overlay and _can_stream_copy(meta):
+        cmd = [*_CMD_HEAD, *_input_args(src_mp4), "-c", "copy", *_output_args("pipe:1")]
+        return meta, _stream_cmd_to_s3(cmd, bucket, key)
+
+    out_meta = {**meta, "fps": TARGET_FPS, "codec": "h264", "pix_fmt": "yuv420p"}
+    try:
+        return out_meta, _stream_cmd_to_s3(
+            _compose_cmd(src_mp4, "pipe:1", overlay, VIDEO_ENCODER,
+                         meta.get("audio_codec", ""), meta.get("fps")), bucket, key)
+    except RuntimeError:
+        if VIDEO_ENCODER == "libx264":
+            raise
+        # same fallback as compose_with_ffmpeg: the device may be absent/busy
+        app.logger.warning("%s streaming encode failed; retrying with libx264", VIDEO_ENCODER)
+    return out_meta, _stream_cmd_to_s3(
+        _compose_cmd(src_mp4, "pipe:1", overlay, "libx264",
+                     meta.get("audio_codec", ""), meta.get("fps")), bucket, key)
 
 def post_back_to_breeze(processed_url: str, payload: dict) -> dict:
     """Attach processed video as Manual Upload (Microsite shows it)."""
@@ -305,7 +987,7 @@ def post_back_to_breeze(processed_url: str, payload: dict) -> dict:
         # "title": "Processed",
     }
     try:
-        r = requests.post(BREEZE_UPLOAD_URL, headers=headers, json=body, timeout=REQUEST_TIMEOUT)
+        r = http_session.post(BREEZE_UPLOAD_URL, headers=headers, json=body, timeout=REQUEST_TIMEOUT)
         ok = 200 <= r.status_code < 300
         app.logger.info("Breeze post-back: %s %s", r.status_code, r.text[:400])
         return {"status": "ok" if ok else "error", "code": r.status_code, "body": r.text}
@@ -313,9 +995,161 @@ def post_back_to_breeze(processed_url: str, payload: dict) -> dict:
         app.logger.exception("Breeze post-back failed")
         return {"status": "error", "error": str(e)}
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Render job (download → ffmpeg → upload → post-back)
+# ──────────────────────────────────────────────────────────────────────────────
+# Breeze retries webhooks; remember finished renders so a retry for the same
+# uid + source returns the earlier result instead of redoing every stage.
+# Presigned results are only replayed for half their lifetime, so a retry never
+# gets back a processed_url that has expired (or is about to).
+_RENDER_CACHE_TTL = PRESIGN_TTL / 2 if PRESIGN_TTL > 0 and not MAKE_PUBLIC else None
+_render_cache: "OrderedDict[Tuple[str, str], Tuple[float, dict]]" = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def _recent_render(uid: str, mp4_url: str) -> Optional[dict]:
+    with _render_cache_lock:
+        hit = _render_cache.get((uid, mp4_url))
+        if hit is None:
+            return None
+        stored_at, result = hit
+        if _RENDER_CACHE_TTL is not None and time.time() - stored_at > _RENDER_CACHE_TTL:
+            del _render_cache[(uid, mp4_url)]
+            return None
+        _render_cache.move_to_end((uid, mp4_url))
+        return result
+
+def _remember_render(uid: str, mp4_url: str, result: dict):
+    with _render_cache_lock:
+        _render_cache[(uid, mp4_url)] = (time.time(), result)
+        _render_cache.move_to_end((uid, mp4_url))
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+
+@contextlib.contextmanager
+def _scratch_dir(uid: str):
+    """Per-render dir under the (tmpfs) scratch root; removed off the request
+    path so freeing a large source/output doesn't delay post-back or response."""
+    tmp = tempfile.mkdtemp(prefix=str(uid)[:40].replace("/", "_") + "-")
+    try:
+        yield tmp
+    finally:
+        io_pool.submit(shutil.rmtree, tmp, True)
+
+def render_job(mp4_url: str, uid: str, payload: dict, started: float) -> dict:
+    done = _recent_render(uid, mp4_url)
+    if done is not None:
+        app.logger.info("♻️  duplicate webhook uid=%s; returning earlier render", uid)
+        return done
+
+    # Work in /tmp
+    with _counted_render(), _scratch_dir(uid) as tmp:
+        src = os.path.join(tmp, "source.mp4")
+        out = os.path.join(tmp, f"{uid}_final.mp4")
+        key = f"{OUTPUT_PREFIX.rstrip('/')}/{uid}_final.mp4"
+
+        if OVERLAY_S3_KEY:
+            # source and overlay are independent fetches; run them side by side.
+            # The overlay is usually a cache hit, so resolve it on this thread
+            # while the pool pulls the source.
+            # ffprobe only needs the moov header, so probe the URL during the
+            # download instead of probing the local copy after it.
+            src_job = io_pool.submit(_download, mp4_url, src)
+            probe_job = io_pool.submit(ffprobe_meta, mp4_url)
+            overlay = maybe_download_overlay()
+            src_job.result()
+            src_meta = probe_job.result()
+            source = src
+        else:
+            # no overlay: ffmpeg reads the source straight off HTTP, no staging copy.
+            # Probe it once here so the streaming and file paths share the result.
+            overlay, source, src_meta = None, mp4_url, ffprobe_meta(mp4_url)
+
+        meta = None
+        if STREAM_UPLOAD:
+            try:
+                meta, processed_url = compose_to_s3(source, overlay, S3_BUCKET, key, src_meta)
+            except RuntimeError as e:
+                app.logger.warning("Streaming render failed; rendering to file: %s", e)
+        if meta is None:
+            try:
+                meta = compose_with_ffmpeg(source, out, overlay, src_meta)
+            except RuntimeError as e:
+                if source == src:
+                    raise
+                app.logger.warning("Direct URL input failed; staging source to disk: %s", e)
+                _download(mp4_url, src)
+                meta = compose_with_ffmpeg(src, out, None)
+            processed_url = s3_upload(out, S3_BUCKET, key)
+
+    breeze = post_back_to_breeze(processed_url, payload) if POST_BACK_TO_BREEZE else {"status": "skipped"}
+    took = round(time.time() - started, 2)
+    app.logger.info("✅ done uid=%s time=%0.2fs meta=%s", uid, took, meta)
+    result = {
+        "status": "ok",
+        "uid": uid,
+        "processed_url": processed_url,
+        "width": meta.get("width"),
+        "height": meta.get("height"),
+        "fps": meta.get("fps") or TARGET_FPS,
+        "breeze": breeze
+    }
+    # a failed post-back isn't final: let the retry render and post again
+    if breeze.get("status") != "error":
+        _remember_render(uid, mp4_url, result)
+    return result
+
+# Async job states for GET /status/<uid>, oldest evicted first. Per process:
+# with several gunicorn workers, poll through the same worker or use post-back.
+_jobs: "OrderedDict[str, dict]" = OrderedDict()
+_jobs_lock = threading.Lock()
+_jobs_pending = 0
+
+def _set_job(uid, state: dict):
+    uid = str(uid)  # payload ids are often JSON ints; /status/<uid> is always a str
+    with _jobs_lock:
+        _jobs[uid] = state
+        _jobs.move_to_end(uid)
+        while len(_jobs) > RENDER_CACHE_SIZE:
+            _jobs.popitem(last=False)
+
+def _enqueue_render(mp4_url: str, uid: str, payload: dict, started: float) -> bool:
+    """Queue an async render; False when the backlog is already full."""
+    global _jobs_pending
+    with _jobs_lock:
+        if _jobs_pending >= RENDER_QUEUE_MAX:
+            return False
+        _jobs_pending += 1
+    _set_job(uid, {"status": "queued", "uid": uid})
+    render_pool.submit(_render_job_logged, mp4_url, uid, payload, started)
+    return True
+
+def _render_job_logged(mp4_url: str, uid: str, payload: dict, started: float):
+    global _jobs_pending
+    _set_job(uid, {"status": "running", "uid": uid})
+    try:
+        _set_job(uid, render_job(mp4_url, uid, payload, started))
+    except Exception as e:
+        app.logger.exception("Render job failed")
+        _set_job(uid, {"status": "error", "uid": uid, "error": str(e)})
+    finally:
+        with _jobs_lock:
+            _jobs_pending -= 1
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Routes
 # ──────────────────────────────────────────────────────────────────────────────
+def _json(obj, status: int = 200):
+    # orjson instead of jsonify: no stdlib encoder, no sort_keys pass
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
+@app.get("/status/<uid>")
+def status(uid: str):
+    with _jobs_lock:
+        job = _jobs.get(uid)
+    if job is None:
+        return _json({"status": "unknown", "uid": uid}, 404)
+    return _json(job)
+
 @app.get("/health")
 def health():
     return "ok"
@@ -327,20 +1161,31 @@ def root():
 @app.get("/warmup")
 def warmup():
     try:
-        s3.list_buckets()
+        # opens (and keeps) a TLS connection to the bucket's own endpoint,
+        # the one uploads use; list_buckets only warmed the service endpoint
+        s3.head_bucket(Bucket=S3_BUCKET)
     except Exception:
         pass
-    return jsonify({"status": "ok"})
+    # cold container: pull the overlay now rather than on the first render
+    overlay = maybe_download_overlay() if OVERLAY_S3_KEY else None
+    return _json({"status": "ok", "overlay": bool(overlay)})
 
 @app.post("/webhook")
 def webhook():
     started = time.time()
-    raw = request.get_data(as_text=True)[:1500]
-    app.logger.info("Webhook received raw (first 1500 chars): %s", raw)
+    if MAX_TMP_MB and shutil.disk_usage(tempfile.gettempdir()).free < 2 * MAX_TMP_MB * 1024 * 1024:
+        # source + output won't fit in scratch; let the sender retry later
+        app.logger.warning("⚠️ scratch space low in %s; refusing webhook", tempfile.gettempdir())
+        return _json({"status": "busy", "reason": "scratch_full"}, 503)
+    body = request.get_data()
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("Webhook received raw (first 1500 chars): %s", body[:1500].decode("utf-8", "ignore"))
 
     try:
-        payload = request.get_json(force=True)
-    except Exception:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        payload = {}
+    if not isinstance(payload, dict):
         payload = {}
 
     # identify
@@ -352,17 +1197,43 @@ def webhook():
     session_id = payload.get("eventkitesessionid")
     gallery_id = payload.get("eventkitegalleryid")
 
+    urls = _payload_urls(payload)
+
     # 1) direct mp4 url provided?
     mp4_url = None
-    if isinstance(payload.get("mp4_url"), str) and ".mp4" in payload["mp4_url"]:
-        mp4_url = payload["mp4_url"]
-        app.logger.info("🎬 MP4 detected (direct): %s", mp4_url)
+    for k in DIRECT_MP4_KEYS:
+        if ".mp4" in urls.get(k, ""):
+            mp4_url = urls[k]
+            app.logger.info("🎬 MP4 detected (direct %s): %s", k, mp4_url)
+            break
+
+    # 1b) any .mp4 URL anywhere in the raw body? one flat scan is far cheaper
+    #     than resolving microsite pages over the network
+    if not mp4_url and b".mp4" in body.lower():
+        # JSON-escaped hits (\/ or \u0026) are left to the structured walk
+        # scan the bytes as-is; only the (ASCII) hits get decoded
+        hits = [h.decode("utf-8", "ignore") for h in dict.fromkeys(MP4_BYTES_RE.findall(body)) if b"\\" not in h]
+        if len(hits) == 1:
+            # the common case: exactly one candidate, nothing to disambiguate
+            mp4_url = hits[0]
+            app.logger.info("🎬 MP4 detected (raw body): %s", mp4_url)
+        else:
+            # zero or several: let the structure (url/href/mime fields) decide.
+            # The walk also matches bare filenames ("IMG_0001.mp4"); only an
+            # absolute URL is usable, anything else falls through to the pages.
+            walked = _find_mp4_in_obj(payload)
+            if walked and walked.startswith(("http://", "https://")):
+                mp4_url = walked
+                app.logger.info("🎬 MP4 detected (payload walk, %d raw hits): %s", len(hits), mp4_url)
+            elif hits:
+                # nothing usable in the structure: first raw hit in document order
+                mp4_url = hits[0]
+                app.logger.info("🎬 MP4 detected (raw body, first of %d): %s", len(hits), mp4_url)
 
     # 2) try page URLs (media_url or image_url)
-    if not mp4_url and isinstance(payload.get("media_url"), str):
-        mp4_url = resolve_mp4_from_page(payload["media_url"])
-    if not mp4_url and isinstance(payload.get("image_url"), str):
-        mp4_url = resolve_mp4_from_page(payload["image_url"])
+    for k in PAGE_URL_KEYS:
+        if not mp4_url and k in urls:
+            mp4_url = resolve_mp4_from_page(urls[k])
 
     # 3) Breeze API fallback by session id (optional)
     if not mp4_url:
@@ -370,33 +1241,15 @@ def webhook():
 
     if not mp4_url:
         app.logger.warning("⚠️ No MP4 found after retries + API fallback; keys=%s", list(payload.keys()))
-        return jsonify({"status": "ignored", "reason": "no_mp4"}), 200
-
-    # Work in /tmp
-    with tempfile.TemporaryDirectory() as tmp:
-        src = os.path.join(tmp, "source.mp4")
-        out = os.path.join(tmp, f"{uid}_final.mp4")
-
-        _download(mp4_url, src)
-        overlay = maybe_download_overlay(tmp)
-        compose_with_ffmpeg(src, out, overlay)
+        return _json({"status": "ignored", "reason": "no_mp4"})
 
-        key = f"{OUTPUT_PREFIX.rstrip('/')}/{uid}_final.mp4"
-        processed_url = s3_upload(out, S3_BUCKET, key)
-        meta = ffprobe_meta(out)
-
-    breeze = post_back_to_breeze(processed_url, payload) if POST_BACK_TO_BREEZE else {"status": "skipped"}
-    took = round(time.time() - started, 2)
-    app.logger.info("✅ done uid=%s time=%0.2fs meta=%s", uid, took, meta)
-    return jsonify({
-        "status": "ok",
-        "uid": uid,
-        "processed_url": processed_url,
-        "width": meta.get("width"),
-        "height": meta.get("height"),
-        "fps": meta.get("fps") or TARGET_FPS,
-        "breeze": breeze
-    })
+    if ASYNC_RENDER:
+        # ack now; Breeze gets the result via post-back, not this response
+        if not _enqueue_render(mp4_url, uid, payload, started):
+            app.logger.warning("⚠️ render queue full (%d); refusing uid=%s", RENDER_QUEUE_MAX, uid)
+            return _json({"status": "busy", "reason": "queue_full"}, 503)
+        return _json({"status": "accepted", "uid": uid}, 202)
+    return _json(render_job(mp4_url, uid, payload, started))
 
 # ──────────────────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
@@ -0,0 +1,25 @@
+# gunicorn -c gunicorn.conf.py app:app
+import os
+import multiprocessing
+
+bind         = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# Requests mostly wait on network I/O and the ffmpeg child process, so threads
+# carry the concurrency. Workers stay few: each ffmpeg already uses every core.
+worker_class = "gthread"
+workers      = int(os.getenv("WEB_CONCURRENCY", str(min(2 * multiprocessing.cpu_count() + 1, 4))))
+# app.py splits the cores across workers as well as across in-flight renders;
+# this file runs in the master before fork, so the workers inherit it
+os.environ["WEB_CONCURRENCY"] = str(workers)
+threads      = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# a synchronous render (download + encode + upload) can take minutes
+timeout      = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+keepalive    = 5
+
+# no preload: app.py starts thread pools (and the overlay warm-up) at import,
+# and threads don't survive fork
+preload_app  = False
+
+accesslog    = "-"
+errorlog     = "-"